@@ -1,10 +1,33 @@
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import io
+import multiprocessing
 import os.path
+import queue
 import re
+import shutil
+import sys
+import time
 
 __version__ = "2.0.0"
 
 import shlex
 
+# Memory per byte of MHL, measured with tracemalloc on synthetic frame- and clip-based tapes (~250 bytes per entry).
+# A worker peaks at 1.6-1.8x while it holds a parsed chunk and the pickle it sends back, the unpickled
+# dictionary the scheduler keeps until the tape is assembled is ~0.9x, and its pickle is ~0.45x
+PARSE_MEMORY_PER_MHL_BYTE = 2
+RESULT_MEMORY_PER_MHL_BYTE = 1
+PICKLE_MEMORY_PER_MHL_BYTE = 0.5
+DEFAULT_MEMORY_BUDGET = 4 * 1000 ** 3
+DEFAULT_CHUNK_SIZE = 256 * 1000 ** 2
+
+# Progress is only checked once per block read from the MHL, and reported at most a few times a second
+PROGRESS_CHECK_BYTES = 1000 ** 2
+PROGRESS_INTERVAL = 0.25
+
 
 class AppleMetadataBlockConfig:
 
@@ -38,9 +61,71 @@ def calculate_size_total(sizes):
         total_size /= 1000
 
 
+class ParseProgress:
+
+    def __init__(self, bytes_total, callback=None, interval=PROGRESS_INTERVAL):
+        self.bytes_total = bytes_total
+        self.bytes_done = 0
+        self.entries = 0
+
+        self.callback = callback
+        self.interval = interval
+
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+        self.finished = False
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    @property
+    def entries_per_second(self):
+        elapsed = self.elapsed
+        return self.entries / elapsed if elapsed else 0.0
+
+    @property
+    def eta(self):
+        if not self.bytes_done:
+            return None
+
+        return self.elapsed * (self.bytes_total - self.bytes_done) / self.bytes_done
+
+    def update(self, bytes_done, entries, finished=False):
+
+        self.bytes_done = bytes_done
+        self.entries = entries
+
+        # the final state is only reported once, however many times it is seen
+        if self.callback is None or self.finished:
+            return
+
+        now = time.monotonic()
+
+        if finished or now - self.last_report >= self.interval:
+            self.last_report = now
+            self.finished = finished
+            self.callback(self)
+
+    def __str__(self):
+
+        if self.bytes_total:
+            percent = f' ({100 * self.bytes_done // self.bytes_total}%)'
+        else:
+            percent = ''
+
+        if self.eta is None:
+            eta = '--:--:--'
+        else:
+            eta = str(datetime.timedelta(seconds=round(self.eta)))
+
+        return f'{calculate_size_total([self.bytes_done])} of {calculate_size_total([self.bytes_total])}{percent}, ' \
+               f'{self.entries} entries, {self.entries_per_second:.0f} entries/s, ETA {eta}'
+
+
 class AppleMetadataBlock:
 
-    def __init__(self, mhl_file_path):
+    def __init__(self, mhl_file_path, mhl_contents=None, write_output=True, progress=None):
 
         self.mhl_file_path = mhl_file_path
         self.files_dictionary = {}
@@ -63,7 +148,10 @@ class AppleMetadataBlock:
 
         self.manual_fix = False
 
-        self.load_mhl_file()
+        if mhl_contents is None:
+            self.load_mhl_file(progress)
+        else:
+            self.files_dictionary, self.software, self.date_written = mhl_contents
 
         self.get_unique_elements()
 
@@ -82,39 +170,25 @@ class AppleMetadataBlock:
         print('Total size: ' + calculate_size_total(self.files_dictionary.values()))
 
         self.compile_block()
-        self.write_block()
-
-    def load_mhl_file(self):
-
-        with open(self.mhl_file_path, 'r') as file_handler:
 
-            lines = file_handler.readlines()
+        if write_output:
+            self.write_block()
 
-            if lines[1].strip() != '<hashlist version="1.1">':
-                raise Exception('Invalid MHL file')
+    def load_mhl_file(self, progress=None):
 
-            for line in lines:
+        check_mhl_header(self.mhl_file_path)
 
-                line = line.strip()
+        with open(self.mhl_file_path, 'rb') as file_handler:
+            files_dictionary, software, date_written = parse_mhl_range(file_handler, 0,
+                                                                       os.path.getsize(self.mhl_file_path), progress)
 
-                if line.startswith('<startdate>'):
-                    self.date_written = mil_date_to_us_date(line.split('>')[1].split('T')[0])
+        self.files_dictionary = files_dictionary
 
-                if line.startswith('<file>'):
+        if software is not None:
+            self.software = software
 
-                    path = line.split('<file>')[1].split('</file>')[0]
-
-                    self.files_dictionary[path] = {}
-
-                elif line.startswith('<size>'):
-
-                    size = line.split('<size>')[1].split('</size>')[0]
-
-                    self.files_dictionary[path] = size
-
-                elif line.startswith('<tool>'):
-
-                    self.software = line.split('<tool>')[1].split('</tool>')[0]
+        if date_written is not None:
+            self.date_written = date_written
 
     def get_unique_elements(self):
 
@@ -299,6 +373,492 @@ class AppleMetadataBlock:
             f.write(block)
 
 
+class BatchScheduler:
+
+    def __init__(self, workers=None, memory_budget=DEFAULT_MEMORY_BUDGET, chunk_size=DEFAULT_CHUNK_SIZE,
+                 write_output=True, show_progress=True):
+        self.workers = workers or os.cpu_count() or 1
+        self.memory_budget = memory_budget
+        self.chunk_size = chunk_size
+        self.write_output = write_output
+        self.show_progress = show_progress
+
+        self.blocks = {}
+        self.failures = {}
+
+        self.tape_order = {}
+        self.pending = []
+        self.ready = []
+        self.in_flight = {}
+        self.building = {}
+        self.chunk_results = {}
+        self.suspects = set()
+        self.isolated = None
+
+        # memory held by chunk results waiting for the rest of their tape
+        self.retained_memory = {}
+
+        self.tape_progress = {}
+        self.chunk_progress = {}
+
+        # one status line per tape still being read, redrawn together below everything else printed
+        self.progress_lines = {}
+        self.lines_drawn = 0
+
+    def run(self, mhl_file_paths):
+
+        # largest tapes first, so one giant tape doesn't end up running alone at the end of the batch
+        mhl_file_paths = sorted(mhl_file_paths, key=os.path.getsize, reverse=True)
+
+        self.tape_order = {mhl_file_path: order for order, mhl_file_path in enumerate(mhl_file_paths)}
+        self.pending = []
+        self.ready = []
+        self.in_flight = {}
+        self.building = {}
+        self.chunk_results = {}
+
+        # tapes that were in the pool when a worker died; their work is retried one task at a time,
+        # so if the pool breaks again it can only have been them
+        self.suspects = set()
+        self.isolated = None
+
+        for mhl_file_path in mhl_file_paths:
+            try:
+                check_mhl_header(mhl_file_path)
+            except Exception as e:
+                self.fail(mhl_file_path, e)
+                continue
+
+            chunks = split_mhl_file(mhl_file_path, self.chunk_size)
+            self.chunk_results[mhl_file_path] = [None] * len(chunks)
+            self.chunk_progress[mhl_file_path] = [(0, 0)] * len(chunks)
+
+            for index, (start, end) in enumerate(chunks):
+                self.pending.append((mhl_file_path, index, start, end))
+
+        with multiprocessing.Manager() as manager:
+
+            progress_queue = manager.Queue()
+            executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+            broken = False
+
+            try:
+                while self.pending or self.ready or self.in_flight or self.building:
+
+                    # a worker died (usually the OOM killer), so every task that was in the pool has failed;
+                    # once they have all been collected, carry on in a fresh pool
+                    if broken and not self.in_flight and not self.building:
+                        executor.shutdown()
+                        executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+                        broken = False
+
+                    try:
+                        if not broken:
+                            self.submit(executor, progress_queue)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken = True
+
+                    done, _ = concurrent.futures.wait(list(self.in_flight) + list(self.building),
+                                                      timeout=PROGRESS_INTERVAL,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+
+                    self.collect_progress(progress_queue)
+
+                    for future in done:
+
+                        if isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+                            broken = True
+                            self.retry(future)
+
+                        elif future in self.building:
+                            mhl_file_path, mhl_contents, _ = self.building.pop(future)
+                            self.finish_block(mhl_file_path, future)
+
+                        else:
+                            self.finish_chunk(future)
+
+                    if not self.in_flight and not self.building:
+                        self.isolated = None
+
+            finally:
+                executor.shutdown()
+
+        return self.blocks
+
+    def submit(self, executor, progress_queue):
+
+        # a suspect tape runs on its own, so nothing else starts alongside it
+        if any(mhl_file_path in self.suspects for mhl_file_path in self.tapes_in_pool()):
+            return
+
+        # assembling a tape frees its chunk results, so it goes ahead of any new chunks; if it doesn't fit in the
+        # budget yet, no new chunks start either, so it can't be starved by them
+        while self.ready and self.slots_free():
+            mhl_file_path, mhl_contents = self.ready[0]
+            cost = estimate_build_memory(os.path.getsize(mhl_file_path))
+
+            if mhl_file_path in self.suspects and self.tapes_in_pool():
+                return
+
+            if self.tapes_in_pool() and self.memory_in_use() + cost > self.memory_budget:
+                return
+
+            # the executor keeps the arguments until the result comes back, so the parent's copy stays
+            # counted in retained_memory until the build has finished
+            future = executor.submit(build_metadata_block, mhl_file_path, mhl_contents, self.write_output)
+            self.building[future] = (mhl_file_path, mhl_contents, cost)
+            self.ready.pop(0)
+
+            if mhl_file_path in self.suspects:
+                self.isolated = mhl_file_path
+                return
+
+        # first fit, in queue order (largest tape first): start every chunk that still fits in the memory budget
+        for task in list(self.pending):
+
+            if not self.slots_free():
+                break
+
+            mhl_file_path, index, start, end = task
+            cost = estimate_memory(end - start)
+
+            if mhl_file_path in self.suspects and self.tapes_in_pool():
+                continue
+
+            # a chunk larger than the whole budget is allowed to run on its own
+            if self.tapes_in_pool() and self.memory_in_use() + cost > self.memory_budget:
+                continue
+
+            future = executor.submit(parse_mhl_chunk, mhl_file_path, start, end,
+                                     QueueProgress(progress_queue, (mhl_file_path, index)))
+            self.in_flight[future] = (task, cost)
+            self.pending.remove(task)
+
+            # the clock starts with the tape's first chunk, not while it waits behind other tapes
+            if mhl_file_path not in self.tape_progress:
+                callback = functools.partial(self.print_progress, mhl_file_path) if self.show_progress else None
+                self.tape_progress[mhl_file_path] = ParseProgress(os.path.getsize(mhl_file_path), callback)
+
+            if mhl_file_path in self.suspects:
+                self.isolated = mhl_file_path
+                return
+
+    def finish_chunk(self, future):
+
+        (mhl_file_path, index, start, end), _ = self.in_flight.pop(future)
+
+        if mhl_file_path not in self.chunk_results:
+            return
+
+        try:
+            self.chunk_results[mhl_file_path][index] = future.result()
+        except Exception as e:
+            self.fail(mhl_file_path, e)
+            return
+
+        self.retained_memory[mhl_file_path] = self.retained_memory.get(mhl_file_path, 0) + \
+            estimate_result_memory(end - start)
+
+        chunk_files = self.chunk_results[mhl_file_path][index][0]
+        self.update_progress(mhl_file_path, index, end - start, len(chunk_files))
+
+        if all(result is not None for result in self.chunk_results[mhl_file_path]):
+            self.ready.append((mhl_file_path, merge_mhl_chunks(self.chunk_results.pop(mhl_file_path))))
+
+    def retry(self, future):
+
+        if future in self.building:
+            mhl_file_path, mhl_contents, _ = self.building.pop(future)
+            task = None
+        else:
+            task, _ = self.in_flight.pop(future)
+            mhl_file_path = task[0]
+
+        # a tape that breaks the pool while running on its own is the one that broke it
+        if mhl_file_path == self.isolated:
+            self.fail(mhl_file_path, future.exception())
+            return
+
+        if mhl_file_path in self.failures:
+            return
+
+        self.suspects.add(mhl_file_path)
+
+        if task is None:
+            self.ready.insert(0, (mhl_file_path, mhl_contents))
+        else:
+            self.chunk_progress[mhl_file_path][task[1]] = (0, 0)
+            self.pending.append(task)
+            self.pending.sort(key=lambda pending_task: (self.tape_order[pending_task[0]], pending_task[1]))
+
+    def tapes_in_pool(self):
+        return [task[0] for task, _ in self.in_flight.values()] + \
+            [mhl_file_path for mhl_file_path, _, _ in self.building.values()]
+
+    def slots_free(self):
+        return len(self.in_flight) + len(self.building) < self.workers
+
+    def memory_in_use(self):
+        return sum(cost for _, cost in self.in_flight.values()) + \
+            sum(cost for _, _, cost in self.building.values()) + sum(self.retained_memory.values())
+
+    def collect_progress(self, progress_queue):
+
+        while True:
+            try:
+                (mhl_file_path, index), bytes_done, entries = progress_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            self.update_progress(mhl_file_path, index, bytes_done, entries)
+
+    def update_progress(self, mhl_file_path, index, bytes_done, entries):
+
+        # progress from tapes that have already finished or failed can still be sitting in the queue
+        if mhl_file_path not in self.tape_progress:
+            return
+
+        self.chunk_progress[mhl_file_path][index] = (bytes_done, entries)
+
+        tape_progress = self.tape_progress[mhl_file_path]
+        tape_bytes_done = sum(chunk[0] for chunk in self.chunk_progress[mhl_file_path])
+        tape_entries = sum(chunk[1] for chunk in self.chunk_progress[mhl_file_path])
+
+        tape_progress.update(tape_bytes_done, tape_entries, finished=tape_bytes_done >= tape_progress.bytes_total)
+
+    def print_progress(self, mhl_file_path, parse_progress):
+
+        line = f"{os.path.basename(mhl_file_path)}: {parse_progress}"
+
+        if parse_progress.finished:
+            self.progress_lines.pop(mhl_file_path, None)
+            self.print_above(line)
+        else:
+            self.progress_lines[mhl_file_path] = line
+            self.draw_progress()
+
+    def print_above(self, text):
+
+        self.erase_progress()
+        print(text)
+        self.draw_progress()
+
+    def erase_progress(self):
+
+        # move back up over the status lines and clear to the end of the screen
+        if self.lines_drawn:
+            print(f'\x1b[{self.lines_drawn}F\x1b[J', end='')
+            self.lines_drawn = 0
+
+    def draw_progress(self):
+
+        # redrawing needs cursor movement, so when output isn't a terminal only the final line of each tape is printed
+        if not sys.stdout.isatty():
+            return
+
+        self.erase_progress()
+
+        # a line that wraps would throw out the cursor movement, so cut it to the width of the terminal
+        width = shutil.get_terminal_size().columns - 1
+
+        for line in self.progress_lines.values():
+            print(line[:width])
+
+        self.lines_drawn = len(self.progress_lines)
+        sys.stdout.flush()
+
+    def finish_block(self, mhl_file_path, future):
+
+        try:
+            block, output = future.result()
+        except Exception as e:
+            self.fail(mhl_file_path, e)
+            return
+
+        self.forget_progress(mhl_file_path)
+        self.print_above(f"Processing {os.path.basename(mhl_file_path)}\n{output}".rstrip('\n'))
+
+        self.blocks[mhl_file_path] = block
+        self.retained_memory.pop(mhl_file_path, None)
+        self.suspects.discard(mhl_file_path)
+
+    def fail(self, mhl_file_path, error):
+
+        # drop whatever else of the tape is still queued, its block can't be produced now
+        self.chunk_results.pop(mhl_file_path, None)
+        self.pending = [task for task in self.pending if task[0] != mhl_file_path]
+        self.suspects.discard(mhl_file_path)
+
+        self.forget_progress(mhl_file_path)
+        self.print_above(f"Failed {os.path.basename(mhl_file_path)}: {error}")
+        self.failures[mhl_file_path] = error
+        self.retained_memory.pop(mhl_file_path, None)
+
+    def forget_progress(self, mhl_file_path):
+        self.tape_progress.pop(mhl_file_path, None)
+        self.chunk_progress.pop(mhl_file_path, None)
+        self.progress_lines.pop(mhl_file_path, None)
+
+
+def build_metadata_block(mhl_file_path, mhl_contents, write_output=True):
+
+    # runs in a worker, so its summary is captured and printed by the scheduler instead of interleaving
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        block = AppleMetadataBlock(mhl_file_path, mhl_contents, write_output).compile_block()
+
+    return block, output.getvalue()
+
+
+def estimate_memory(mhl_bytes):
+    return mhl_bytes * PARSE_MEMORY_PER_MHL_BYTE
+
+
+def estimate_result_memory(mhl_bytes):
+    return mhl_bytes * RESULT_MEMORY_PER_MHL_BYTE
+
+
+def estimate_build_memory(mhl_bytes):
+    # the pickle sent to the worker plus the worker's own copy of the dictionary, on top of the parent's copy
+    return mhl_bytes * (PICKLE_MEMORY_PER_MHL_BYTE + RESULT_MEMORY_PER_MHL_BYTE)
+
+
+def check_mhl_header(mhl_file_path):
+
+    with open(mhl_file_path, 'r') as file_handler:
+        file_handler.readline()
+
+        if file_handler.readline().strip() != '<hashlist version="1.1">':
+            raise Exception('Invalid MHL file')
+
+
+def split_mhl_file(mhl_file_path, chunk_size=DEFAULT_CHUNK_SIZE):
+
+    # chunks always start on a <hash> line, so no entry is split between two chunks
+    file_size = os.path.getsize(mhl_file_path)
+    boundaries = [0]
+
+    with open(mhl_file_path, 'rb') as file_handler:
+
+        offset = chunk_size
+
+        while offset < file_size:
+
+            file_handler.seek(offset)
+            file_handler.readline()
+
+            position = file_handler.tell()
+            line = file_handler.readline()
+
+            while line and not line.strip().startswith(b'<hash>'):
+                position = file_handler.tell()
+                line = file_handler.readline()
+
+            if not line:
+                break
+
+            boundaries.append(position)
+            offset = position + chunk_size
+
+    boundaries.append(file_size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parse_mhl_chunk(mhl_file_path, start, end, progress=None):
+
+    with open(mhl_file_path, 'rb') as file_handler:
+        return parse_mhl_range(file_handler, start, end, progress)
+
+
+def parse_mhl_range(file_handler, start, end, progress=None):
+
+    # shared by load_mhl_file and the chunked parser; software and date are None when not seen,
+    # so chunk results can be merged in order
+    files_dictionary = {}
+    software = None
+    date_written = None
+
+    parse_progress = ParseProgress(end - start, progress)
+    position = start
+
+    file_handler.seek(start)
+
+    while position < end:
+
+        # read whole lines in binary so progress counts bytes, then decode them the same way open(..., 'r') would
+        block = file_handler.read(min(PROGRESS_CHECK_BYTES, end - position))
+
+        if not block:
+            break
+
+        if not block.endswith(b'\n') and position + len(block) < end:
+            block += file_handler.readline()
+
+        position += len(block)
+
+        for line in io.TextIOWrapper(io.BytesIO(block)):
+
+            line = line.strip()
+
+            if line.startswith('<startdate>'):
+                date_written = mil_date_to_us_date(line.split('>')[1].split('T')[0])
+
+            if line.startswith('<file>'):
+
+                path = line.split('<file>')[1].split('</file>')[0]
+
+                files_dictionary[path] = {}
+
+            elif line.startswith('<size>'):
+
+                size = line.split('<size>')[1].split('</size>')[0]
+
+                files_dictionary[path] = size
+
+            elif line.startswith('<tool>'):
+
+                software = line.split('<tool>')[1].split('</tool>')[0]
+
+        parse_progress.update(position - start, len(files_dictionary))
+
+    parse_progress.update(end - start, len(files_dictionary), finished=True)
+
+    return files_dictionary, software, date_written
+
+
+class QueueProgress:
+
+    # picklable progress callback, so chunks parsed in worker processes can report back to the scheduler
+    def __init__(self, progress_queue, task):
+        self.progress_queue = progress_queue
+        self.task = task
+
+    def __call__(self, parse_progress):
+        self.progress_queue.put((self.task, parse_progress.bytes_done, parse_progress.entries))
+
+
+def merge_mhl_chunks(chunk_results):
+
+    files_dictionary = {}
+    software = ""
+    date_written = ""
+
+    # later chunks win, the same as reading the file top to bottom
+    for chunk_files, chunk_software, chunk_date_written in chunk_results:
+
+        files_dictionary.update(chunk_files)
+
+        if chunk_software is not None:
+            software = chunk_software
+
+        if chunk_date_written is not None:
+            date_written = chunk_date_written
+
+    return files_dictionary, software, date_written
+
+
 def mil_date_to_us_date(date):
 
     if "-" in date:
@@ -316,15 +876,17 @@ if __name__ == "__main__":
     filenames = input("Drop tape MHLs here...")
     filenames = shlex.split(filenames)
 
+    mhl_files = []
+
     for filename in filenames:
 
         if os.path.isfile(filename) and filename.endswith('.mhl'):
-            print(f"Processing {os.path.basename(filename)}")
-            AppleMetadataBlock(filename)
+            mhl_files.append(filename)
 
         elif os.path.isdir(filename):
             print(f"Processing folder {os.path.basename(filename)}")
             for filename_in_folder in os.listdir(filename):
                 if filename_in_folder.endswith('.mhl'):
-                    print(f"Processing {os.path.basename(filename_in_folder)}")
-                    AppleMetadataBlock(filename + '/' + filename_in_folder)
+                    mhl_files.append(filename + '/' + filename_in_folder)
+
+    BatchScheduler().run(mhl_files)
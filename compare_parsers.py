@@ -0,0 +1,332 @@
+import contextlib
+import difflib
+import functools
+import io
+import os.path
+import sys
+import tempfile
+import time
+import zlib
+
+import apple_metadata_block as amb
+
+# Checks that the library's parser and every optimised path produce exactly the same block as the
+# original load_mhl_file -> compile_block path. Run from anywhere:
+#
+#   python compare_parsers.py [extra sanitized .mhl files or folders...]
+#
+# Every .mhl in samples/ is always checked as well. The samples there are hand-written to follow the layouts
+# that offload tools produce (multi-line creatorinfo, tab indentation, CRLF, xxhash and md5 entries); sanitized
+# MHLs from real tapes belong in the same folder.
+
+SAMPLES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+
+MHL_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<hashlist version="1.1">
+  <creatorinfo>
+    <name>Cinelab</name>
+    <startdate>{startdate}</startdate>
+    <tool>{tool}</tool>
+  </creatorinfo>
+'''
+
+MHL_ENTRY = '''  <hash>
+    <file>{path}</file>
+    <size>{size}</size>
+    <md5>{md5}</md5>
+    <hashdate>2023-03-14T10:00:00Z</hashdate>
+  </hash>
+'''
+
+MHL_FOOTER = '''</hashlist>
+'''
+
+# (barcode, project, days, camera rolls, sound rolls, clips per roll, frames per clip, options)
+SYNTHETIC_TAPES = [
+    ('KNGD01', 'KINGDOM', ['MU001'], ['A001', 'B001'], ['S001'], 20, 1, {}),
+    ('KNGD02', 'KINGDOM', ['MU014', '2U003'], ['A012', 'C004', 'Z002', 'DJI_E001'], ['S014'], 4, 400, {}),
+    ('KNGD03', 'KINGDOM', ['MU020', 'SU001', 'TE002'], ['A020', 'WEB001', 'CCTV01'], [], 10, 1,
+     {'crlf': True}),
+    ('KNGD04', 'KINGDOM', ['MU021', 'XX001'], ['A021', 'Q001'], ['S021'], 5, 1, {'duplicates': True}),
+    ('CHLG01', 'CHALLENGE', ['MU001'], ['A001R2CD', 'X001', 'G001', 'I002_mezz'], ['S001'], 30, 1, {}),
+    ('CHLG02', 'CHALLENGE', ['MU002', 'MU003'], ['B002R1AB', 'C003RXYZ'], ['S002', 'S003'], 6, 2000,
+     {'unicode': True, 'tools': 2}),
+]
+
+
+def write_synthetic_mhl(folder, barcode, project, days, camera_rolls, sound_rolls, clips, frames, options):
+
+    entries = []
+
+    for day_index, day in enumerate(days):
+        day_folder = f'{day_index + 1:03d}_{project}_202303{day_index + 10:02d}-{day}'
+
+        for roll_type, rolls in (('CAMERA', camera_rolls), ('SOUND', sound_rolls)):
+            for roll in rolls:
+                for clip in range(clips):
+                    clip_name = f'{roll}C{clip:03d}'
+
+                    if options.get('unicode'):
+                        clip_name += '_café'
+
+                    for frame in range(frames if roll_type == 'CAMERA' else 1):
+                        extension = 'wav' if roll_type == 'SOUND' else ('ari' if frames > 1 else 'mov')
+                        path = f'{barcode}/DAILIES/ORIGINALS/{day_folder}/{roll_type}/{roll}/' \
+                               f'{clip_name}/{clip_name}.{frame:07d}.{extension}'
+                        entries.append((path, 1000 + zlib.crc32(path.encode())))
+
+    if options.get('duplicates'):
+        entries += entries[:3]
+
+    content = MHL_HEADER.format(startdate='2023-03-14T09:30:00Z', tool='Hedge 22.2')
+
+    for tool_index in range(1, options.get('tools', 1)):
+        content += f'  <creatorinfo>\n    <tool>Hedge 22.{2 + tool_index}</tool>\n  </creatorinfo>\n'
+
+    for path, size in entries:
+        content += MHL_ENTRY.format(path=path, size=size, md5=f'{size:032x}')
+
+    content += MHL_FOOTER
+
+    if options.get('crlf'):
+        content = content.replace('\n', '\r\n')
+
+    mhl_file_path = os.path.join(folder, f'{barcode}.mhl')
+
+    with open(mhl_file_path, 'w', newline='') as f:
+        f.write(content)
+
+    return mhl_file_path
+
+
+def reference_load_mhl_file(mhl_file_path):
+
+    # frozen copy of the original AppleMetadataBlock.load_mhl_file (v2.0.0), so changes to the
+    # library's parser are always checked against what it used to produce
+    files_dictionary = {}
+    software = ""
+    date_written = ""
+
+    with open(mhl_file_path, 'r') as file_handler:
+
+        lines = file_handler.readlines()
+
+        if lines[1].strip() != '<hashlist version="1.1">':
+            raise Exception('Invalid MHL file')
+
+        for line in lines:
+
+            line = line.strip()
+
+            if line.startswith('<startdate>'):
+                date_written = amb.mil_date_to_us_date(line.split('>')[1].split('T')[0])
+
+            if line.startswith('<file>'):
+
+                path = line.split('<file>')[1].split('</file>')[0]
+
+                files_dictionary[path] = {}
+
+            elif line.startswith('<size>'):
+
+                size = line.split('<size>')[1].split('</size>')[0]
+
+                files_dictionary[path] = size
+
+            elif line.startswith('<tool>'):
+
+                software = line.split('<tool>')[1].split('</tool>')[0]
+
+    return files_dictionary, software, date_written
+
+
+def reference_block(mhl_file_path):
+    mhl_contents = reference_load_mhl_file(mhl_file_path)
+
+    return amb.AppleMetadataBlock(mhl_file_path, mhl_contents, write_output=False).compile_block()
+
+
+def library_block(mhl_file_path):
+    return amb.AppleMetadataBlock(mhl_file_path, write_output=False).compile_block()
+
+
+def chunked_block(mhl_file_path, chunk_size):
+    chunks = amb.split_mhl_file(mhl_file_path, chunk_size)
+    mhl_contents = amb.merge_mhl_chunks([amb.parse_mhl_chunk(mhl_file_path, start, end) for start, end in chunks])
+
+    return amb.AppleMetadataBlock(mhl_file_path, mhl_contents, write_output=False).compile_block()
+
+
+def scheduled_block(mhl_file_path, chunk_size):
+    scheduler = amb.BatchScheduler(chunk_size=chunk_size, write_output=False, show_progress=False)
+    blocks = scheduler.run([mhl_file_path])
+
+    if mhl_file_path in scheduler.failures:
+        raise scheduler.failures[mhl_file_path]
+
+    return blocks[mhl_file_path]
+
+
+def optimised_paths(mhl_file_path):
+
+    file_size = os.path.getsize(mhl_file_path)
+
+    yield 'load_mhl_file', functools.partial(library_block, mhl_file_path)
+
+    # one chunk, a handful of chunks, and as many chunks as there are entries
+    for chunk_size in (file_size, max(file_size // 7, 1), 1):
+        yield f'chunked/{chunk_size}', functools.partial(chunked_block, mhl_file_path, chunk_size)
+
+    for chunk_size in (file_size, max(file_size // 7, 1)):
+        yield f'scheduler/{chunk_size}', functools.partial(scheduled_block, mhl_file_path, chunk_size)
+
+
+def timed(function):
+
+    start = time.perf_counter()
+
+    # the block generator prints a summary for every tape, which would swamp the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+
+    return result, time.perf_counter() - start
+
+
+def check(name, expected, block):
+
+    if block == expected:
+        return 0
+
+    print(f'    {name}: MISMATCH')
+
+    for line in difflib.unified_diff(expected.splitlines(), block.splitlines(), 'reference', name, lineterm=''):
+        print(f'        {line}')
+
+    return 1
+
+
+def report_error(name, error):
+    print(f'    {name}: ERROR {type(error).__name__}: {error}')
+
+
+def compare(mhl_file_path):
+
+    name = os.path.basename(mhl_file_path)
+
+    try:
+        expected, reference_time = timed(functools.partial(reference_block, mhl_file_path))
+    except Exception as e:
+        # without a reference block there is nothing to compare this tape against
+        print(f'{name}: reference ERROR {type(e).__name__}: {e}')
+        return 1, None, 0
+
+    failures = 0
+
+    print(f'{name}: reference {reference_time * 1000:.1f}ms')
+
+    # a single tape in isolation: the chunked paths run serially and the scheduler starts a fresh pool,
+    # so these times show the overhead of each path, not a speedup
+    for path_name, function in optimised_paths(mhl_file_path):
+
+        try:
+            block, path_time = timed(function)
+        except Exception as e:
+            report_error(path_name, e)
+            failures += 1
+            continue
+
+        if check(path_name, expected, block) == 0:
+            print(f'    {path_name}: OK, {path_time * 1000:.1f}ms ({path_time / reference_time:.2f}x reference time)')
+        else:
+            failures += 1
+
+    return failures, expected, reference_time
+
+
+def compare_batch(mhl_files, expected_blocks, reference_time):
+
+    # the scheduler is meant to pay off over a whole batch, so time it against reading the tapes one by one
+    scheduler = amb.BatchScheduler(write_output=False, show_progress=False)
+
+    try:
+        blocks, batch_time = timed(functools.partial(scheduler.run, mhl_files))
+    except Exception as e:
+        print(f'Batch of {len(mhl_files)} MHL(s): scheduler ERROR {type(e).__name__}: {e}')
+        return len(mhl_files)
+
+    failures = 0
+
+    print(f'Batch of {len(mhl_files)} MHL(s): reference {reference_time * 1000:.1f}ms, '
+          f'scheduler {batch_time * 1000:.1f}ms with {scheduler.workers} worker(s) '
+          f'({reference_time / batch_time:.2f}x speedup)')
+
+    for mhl_file_path, expected in zip(mhl_files, expected_blocks):
+        name = f'scheduler batch/{os.path.basename(mhl_file_path)}'
+
+        if mhl_file_path in scheduler.failures:
+            report_error(name, scheduler.failures[mhl_file_path])
+            failures += 1
+        else:
+            failures += check(name, expected, blocks[mhl_file_path])
+
+    return failures
+
+
+def collect_mhl_files(filenames):
+
+    mhl_files = []
+
+    for filename in filenames:
+
+        if os.path.isfile(filename) and filename.endswith('.mhl'):
+            mhl_files.append(os.path.abspath(filename))
+
+        elif os.path.isdir(filename):
+            for filename_in_folder in sorted(os.listdir(filename)):
+                if filename_in_folder.endswith('.mhl'):
+                    mhl_files.append(os.path.abspath(os.path.join(filename, filename_in_folder)))
+
+    return mhl_files
+
+
+def main(filenames):
+
+    mhl_files = collect_mhl_files([SAMPLES_FOLDER] + filenames)
+
+    # presets are looked up relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as folder:
+
+        for barcode, project, days, camera_rolls, sound_rolls, clips, frames, options in SYNTHETIC_TAPES:
+            mhl_files.append(write_synthetic_mhl(folder, barcode, project, days, camera_rolls, sound_rolls, clips,
+                                                 frames, options))
+
+        failures = 0
+        expected_blocks = []
+        reference_time = 0
+
+        for mhl_file_path in mhl_files:
+            tape_failures, expected, tape_reference_time = compare(mhl_file_path)
+
+            failures += tape_failures
+            expected_blocks.append(expected)
+            reference_time += tape_reference_time
+
+        # tapes the reference couldn't read are left out of the batch
+        batch = [(mhl_file_path, expected) for mhl_file_path, expected in zip(mhl_files, expected_blocks)
+                 if expected is not None]
+
+        failures += compare_batch([mhl_file_path for mhl_file_path, _ in batch], [expected for _, expected in batch],
+                                  reference_time)
+
+    if failures:
+        print(f'{failures} check(s) failed or differ from the reference')
+        return 1
+
+    print(f'All optimised paths match the reference for {len(mhl_files)} MHL(s)')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))